@@ -2,11 +2,15 @@ import os
 import re
 import json
 import random
+import asyncio
+import functools
+import threading
 import requests
-import time
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict
 from fastapi import FastAPI, Header, HTTPException, BackgroundTasks
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ==========================================
 # 1. CONFIGURATION
@@ -22,29 +26,78 @@ REDIS_URL = os.getenv("REDIS_URL", "")
 # ==========================================
 # 2. STATE MANAGEMENT (REDIS + MEMORY FALLBACK)
 # ==========================================
-MEMORY_DB = {}
+# Memory fallback: bounded LRU with the same 6-hour TTL as the Redis
+# path, so a long-running server can't grow it until OOM (plain dict if
+# cachetools is missing). The lock covers threadpool/background access.
+try:
+    from cachetools import TTLCache
+    MEMORY_DB = TTLCache(maxsize=10000, ttl=21600)
+except ImportError:
+    MEMORY_DB = {}
+MEMORY_LOCK = threading.RLock()
+
+# Optional orjson: C JSON codec, several times faster than stdlib on the
+# session blobs and emits bytes Redis stores as-is (falls back to json)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# One pooled client for the whole process; reconnecting per call would
+# redo URL parsing + socket + AUTH/HELLO on every turn. No
+# decode_responses: session blobs stay bytes end to end.
+REDIS = None
+if REDIS_URL:
+    try:
+        import redis.asyncio as redis
+        REDIS = redis.from_url(REDIS_URL, max_connections=32)
+    except Exception as e:
+        print("STATE: redis client init failed:", str(e))
 
-def get_session(session_id: str):
-    if REDIS_URL:
-        try:
-            import redis
-            r = redis.from_url(REDIS_URL, decode_responses=True)
-            data = r.get(session_id)
-            return json.loads(data) if data else None
-        except Exception as e:
-            print("STATE: redis get failed:", str(e))
-    return MEMORY_DB.get(session_id)
+def intel_as_lists(intel: Dict) -> Dict[str, List[str]]:
+    # Intel lives in state as sets; JSON (Redis / callback) wants lists.
+    return {k: sorted(v) for k, v in intel.items()}
+
+def encode_state(state: Dict) -> bytes:
+    serializable = {**state, "intel": intel_as_lists(state["intel"])}
+    return orjson.dumps(serializable) if orjson else json.dumps(serializable)
+
+def decode_state(data) -> Dict:
+    return orjson.loads(data) if orjson else json.loads(data)
 
-def save_session(session_id: str, data: Dict):
-    if REDIS_URL:
+async def update_session(session_id: str, mutate):
+    """Load-or-init the session, apply mutate(state), persist atomically.
+
+    The Redis path runs under WATCH/MULTI: if another turn for the same
+    session commits between our GET and SETEX, the transaction aborts
+    and we replay mutate on the fresh state instead of losing its intel.
+    The write itself goes through in one MULTI/EXEC round trip.
+    """
+    if REDIS:
         try:
-            import redis
-            r = redis.from_url(REDIS_URL, decode_responses=True)
-            r.setex(session_id, 21600, json.dumps(data))  # 6 hours
-            return
+            async with REDIS.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(session_id)
+                        data = await pipe.get(session_id)
+                        state = decode_state(data) if data else init_session(session_id)
+                        result = mutate(state)
+                        blob = encode_state(state)
+                        pipe.multi()
+                        pipe.setex(session_id, 21600, blob)  # 6 hours
+                        await pipe.execute()
+                        return result
+                    except redis.WatchError:
+                        continue  # concurrent turn won; replay on fresh state
         except Exception as e:
-            print("STATE: redis set failed:", str(e))
-    MEMORY_DB[session_id] = data
+            print("STATE: redis update failed:", str(e))
+    with MEMORY_LOCK:
+        state = MEMORY_DB.get(session_id)
+        if not state:
+            state = init_session(session_id)
+        result = mutate(state)
+        MEMORY_DB[session_id] = state
+    return result
 
 def init_session(session_id: str):
     return {
@@ -54,73 +107,146 @@ def init_session(session_id: str):
         "callbackSent": False,
         "noNewIntelTurns": 0,
         "intel": {
-            "upiIds": [],
-            "bankAccounts": [],
-            "phoneNumbers": [],
-            "phishingLinks": [],
-            "suspiciousKeywords": []
+            "upiIds": set(),
+            "bankAccounts": set(),
+            "phoneNumbers": set(),
+            "phishingLinks": set(),
+            "suspiciousKeywords": set()
         }
     }
 
 # ==========================================
 # 3. INTELLIGENCE EXTRACTION
 # ==========================================
-UPI_RE = re.compile(r"[a-zA-Z0-9.\-_]{2,}@[a-zA-Z]{2,}")
-URL_RE = re.compile(r"https?://\S+|www\.\S+", re.IGNORECASE)
-# Catch bare short links like bit.ly/fakebanksecure (no scheme)
-BARE_DOMAIN_RE = re.compile(r"\b[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(?:/[^\s\]]+)?\b")
-# De-cloaking indian phone numbers like +91 9 8 7 6 5...
-LOOSE_PHONE_RE = re.compile(r"(?:\+?91|0)?[-\s]?(?:\d[-\s]?){10}")
-
-SUSPICIOUS_KEYWORDS = [
+# Optional Google RE2 (falls back to stdlib re if not installed).
+# RE2 matches in linear time, so adversarial scam text (e.g. pages of
+# digits hitting the loose phone pattern) can't trigger catastrophic
+# backtracking in the stdlib NFA.
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+def compile_pattern(pattern: str, ignorecase: bool = False):
+    # RE2 has no lookarounds; route those straight to the stdlib engine
+    if re2 and not any(tok in pattern for tok in ("(?<", "(?=", "(?!")):
+        try:
+            options = re2.Options()
+            options.case_sensitive = not ignorecase
+            return re2.compile(pattern, options)
+        except re2.error:
+            pass  # syntax RE2 doesn't support; use the stdlib engine
+    return re.compile(pattern, re.IGNORECASE if ignorecase else 0)
+
+# One combined scan over the message: UPI handles, scheme'd URLs, bare
+# short links like bit.ly/fakebanksecure, and 9-18 digit account runs,
+# dispatched on m.lastgroup instead of four separate traversals
+INTEL_RE = compile_pattern(
+    r"(?P<upi>[a-zA-Z0-9.\-_]{2,}@[a-zA-Z]{2,})"
+    r"|(?P<url>(?i:https?://\S+|www\.\S+))"
+    r"|(?P<bare>\b[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(?:/[^\s\]]+)?\b)"
+    r"|(?P<bank>\b\d{9,18}\b)"
+)
+# De-cloaking indian phone numbers like +91 9 8 7 6 5...; the
+# lookarounds reject candidates embedded in longer digit runs (and keep
+# this pattern on the stdlib engine, so it stays out of INTEL_RE)
+PHONE_RE = compile_pattern(r"(?<!\d)(?:\+?91|0)?[\s\-]?((?:\d[\s\-]?){9}\d)(?!\d)")
+# Strips the separators the phone pattern allows, at C speed
+DIGIT_ONLY = str.maketrans("", "", " -")
+WS_RE = compile_pattern(r"\s+")
+# Cheap probe: only rewrite the text if it actually has runs of
+# whitespace or newlines/tabs (rare for SMS/chat messages)
+NEEDS_NORM_RE = compile_pattern(r"[ \t\n\r]{2,}|[\t\n\r]")
+
+SUSPICIOUS_KEYWORDS = frozenset({
     "urgent", "verify", "blocked", "suspended", "kyc", "otp", "pin", "upi",
     "collect", "refund", "reward", "lottery", "click", "link", "apk",
     "anydesk", "teamviewer", "quicksupport", "password", "expire"
-]
-
-def normalize_phone(raw: str) -> str:
-    digits = re.sub(r"\D", "", raw)
-    if len(digits) >= 10:
-        last10 = digits[-10:]
-        if last10 and last10[0] in ["5", "6", "7", "8", "9"]:
-            return last10
-    return ""
-
-def extract_intel(text: str) -> Dict[str, List[str]]:
-    text_clean = re.sub(r"\s+", " ", text).strip()
-
-    upis = set(UPI_RE.findall(text_clean))
-
-    urls = set(URL_RE.findall(text_clean))
-    # also catch bare domains if they weren't caught by URL_RE
-    bare = set(BARE_DOMAIN_RE.findall(text_clean))
-    # avoid adding plain words; keep only ones that look link-ish
-    # (this still may catch "SBI.com" etc, which is acceptable for hackathon)
-    urls.update(bare)
-
-    phones = set()
-    for p in LOOSE_PHONE_RE.findall(text_clean):
-        n = normalize_phone(p)
-        if n:
-            phones.add(n)
-
-    # Bank accounts: 9–18 digits (avoid phone numbers)
-    potential_banks = re.findall(r"\b\d{9,18}\b", text_clean)
-    bank_accounts = set()
-    for num in potential_banks:
-        if num not in phones:
-            bank_accounts.add(num)
-
-    found_keywords = {k for k in SUSPICIOUS_KEYWORDS if k in text_clean.lower()}
+})
+
+SCAM_TRIGGERS = frozenset({
+    "blocked", "verify", "kyc", "upi", "pay", "link", "otp", "suspend", "suspended"
+})
+
+# Optional Aho-Corasick: finds every keyword in one pass over the text
+# instead of one scan per keyword (falls back to token intersection).
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+def build_automaton(keywords):
+    if not ahocorasick:
+        return None
+    ac = ahocorasick.Automaton()
+    for kw in keywords:
+        ac.add_word(kw, kw)
+    ac.make_automaton()
+    return ac
+
+SUSPICIOUS_AC = build_automaton(SUSPICIOUS_KEYWORDS)
+TRIGGER_AC = build_automaton(SCAM_TRIGGERS)
+
+def keyword_hits(automaton, keywords, text_lower: str) -> set:
+    if automaton:
+        return {kw for _, kw in automaton.iter(text_lower)}
+    return set(keywords.intersection(text_lower.split()))
+
+INTEL_KEYS = ("upiIds", "bankAccounts", "phoneNumbers", "phishingLinks", "suspiciousKeywords")
+
+def extract_intel(text: str, text_lower: Optional[str] = None) -> Dict[str, frozenset]:
+    if text_lower is None:
+        text_lower = text.lower()
+    return dict(zip(INTEL_KEYS, extract_intel_cached(text, text_lower)))
+
+# Scammers resend the same message verbatim; the cache turns a repeat
+# into one dict lookup instead of a full regex pipeline. Frozensets keep
+# the cached values safe to hand out repeatedly.
+@functools.lru_cache(maxsize=2048)
+def extract_intel_cached(text: str, text_lower: str) -> tuple:
+    if NEEDS_NORM_RE.search(text):
+        text_clean = WS_RE.sub(" ", text).strip()
+    else:
+        text_clean = text.strip()
+
+    # (bare-domain matching still may catch "SBI.com" etc, which is
+    # acceptable for hackathon)
+    upis = set()
+    urls = set()
+    bank_candidates = []
+    for m in INTEL_RE.finditer(text_clean):
+        kind = m.lastgroup
+        if kind == "upi":
+            upis.add(m.group())
+        elif kind == "bank":
+            bank_candidates.append(m.group())
+        else:  # url or bare domain
+            urls.add(m.group())
+
+    phones = {
+        digits for digits in
+        (m.group(1).translate(DIGIT_ONLY) for m in PHONE_RE.finditer(text_clean))
+        if digits[0] in "56789"
+    }
 
-    return {
-        "upiIds": list(upis),
-        "bankAccounts": list(bank_accounts),
-        "phoneNumbers": list(phones),
-        "phishingLinks": list(urls),
-        "suspiciousKeywords": list(found_keywords)
+    # Bank accounts: 9–18 digit runs that aren't (or don't end in) a
+    # phone number we already captured — two O(1) set lookups each
+    bank_accounts = {
+        num for num in bank_candidates
+        if num not in phones and num[-10:] not in phones
     }
 
+    found_keywords = keyword_hits(SUSPICIOUS_AC, SUSPICIOUS_KEYWORDS, text_lower)
+
+    # Same order as INTEL_KEYS
+    return (
+        frozenset(upis),
+        frozenset(bank_accounts),
+        frozenset(phones),
+        frozenset(urls),
+        frozenset(found_keywords),
+    )
+
 # ==========================================
 # 4. AGENT REPLIES (SAFE FALLBACK)
 # ==========================================
@@ -138,121 +264,217 @@ def generate_reply() -> str:
 # ==========================================
 # 5. FASTAPI MODELS
 # ==========================================
-app = FastAPI(title=APP_NAME)
+# orjson-backed responses when available (same optional import as the
+# Redis path); encoding beats the stdlib encoder on every reply
+if orjson:
+    from fastapi.responses import ORJSONResponse
+    app = FastAPI(title=APP_NAME, default_response_class=ORJSONResponse)
+else:
+    app = FastAPI(title=APP_NAME)
 
 class MessageModel(BaseModel):
+    # Don't materialize unknown fields the handler never reads
+    model_config = ConfigDict(extra="ignore")
+
     sender: str
     text: str
     timestamp: int
 
 class PayloadModel(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     sessionId: str
     message: MessageModel
-    conversationHistory: List[MessageModel] = []
-    metadata: Optional[Dict] = None
+    # Plain dicts, capped at 50: the handler never reads history, so
+    # per-item MessageModel validation was pure overhead
+    conversationHistory: List[Dict[str, Any]] = Field(default_factory=list, max_length=50)
+    metadata: Optional[Dict[str, Any]] = None
 
 # ==========================================
 # 6. MANDATORY GUVI CALLBACK
 # ==========================================
-def send_guvi_callback(payload: Dict):
+# One pooled session for all callbacks: keeps the TCP+TLS connection to
+# GUVI alive across retries and closures, and lets urllib3 handle the
+# retry/backoff loop.
+GUVI_SESSION = requests.Session()
+GUVI_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        # urllib3 doesn't retry POST by default; the callback must retry
+        allowed_methods=frozenset({"POST"}),
+    ),
+))
+
+# Optional shared async client (keep-alive + HTTP/2) so outbound calls
+# run on the event loop instead of tying up a threadpool worker; falls
+# back to the pooled requests session above.
+try:
+    import httpx
+    ASYNC_CLIENT = httpx.AsyncClient(
+        http2=True,
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+except ImportError:
+    httpx = None
+    ASYNC_CLIENT = None
+
+def send_guvi_callback_sync(payload: Dict):
+    try:
+        r = GUVI_SESSION.post(GUVI_CALLBACK_URL, json=payload, timeout=5)
+        print("GUVI_CALLBACK: status=", r.status_code)
+
+        if 200 <= r.status_code < 300:
+            print("GUVI_CALLBACK: success for sessionId=", payload.get("sessionId"))
+        else:
+            print("GUVI_CALLBACK: failed after retries for sessionId=", payload.get("sessionId"))
+
+    except Exception as e:
+        print("GUVI_CALLBACK: exception:", str(e))
+
+async def send_guvi_callback(payload: Dict):
     # Very explicit logs so you can verify in Render logs
     print("GUVI_CALLBACK: sending for sessionId=", payload.get("sessionId"))
 
+    if ASYNC_CLIENT is None:
+        await asyncio.to_thread(send_guvi_callback_sync, payload)
+        return
+
     try:
         for attempt in range(1, 4):
-            r = requests.post(GUVI_CALLBACK_URL, json=payload, timeout=5)
+            r = await ASYNC_CLIENT.post(GUVI_CALLBACK_URL, json=payload)
             print("GUVI_CALLBACK: attempt", attempt, "status=", r.status_code)
 
             if 200 <= r.status_code < 300:
                 print("GUVI_CALLBACK: success for sessionId=", payload.get("sessionId"))
                 return
 
-            time.sleep(1)
+            await asyncio.sleep(1)
 
         print("GUVI_CALLBACK: failed after retries for sessionId=", payload.get("sessionId"))
 
     except Exception as e:
         print("GUVI_CALLBACK: exception:", str(e))
 
+# One long-lived worker drains closures from a queue, so a burst of
+# sessions closing at once can't fan out into a background task per
+# callback, each holding a connection for the whole retry window.
+CALLBACK_QUEUE: Optional[asyncio.Queue] = None
+
+async def callback_worker():
+    while True:
+        payload = await CALLBACK_QUEUE.get()
+        try:
+            await send_guvi_callback(payload)
+        finally:
+            CALLBACK_QUEUE.task_done()
+
+@app.on_event("startup")
+async def start_callback_worker():
+    global CALLBACK_QUEUE
+    CALLBACK_QUEUE = asyncio.Queue()
+    asyncio.create_task(callback_worker())
+
+@app.on_event("shutdown")
+async def drain_callback_queue():
+    if CALLBACK_QUEUE is not None and not CALLBACK_QUEUE.empty():
+        await CALLBACK_QUEUE.join()
+
 # ==========================================
 # 7. MAIN ENDPOINT
 # ==========================================
+# Intel categories that justify closing the session once they stall
+CRITICAL_KEYS = ("upiIds", "bankAccounts", "phishingLinks", "phoneNumbers")
+
 @app.post("/honeypot")
-def honeypot(req: PayloadModel, background_tasks: BackgroundTasks, x_api_key: str = Header(None)):
+async def honeypot(req: PayloadModel, background_tasks: BackgroundTasks, x_api_key: str = Header(None)):
 
     # Auth
     if x_api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Invalid API Key")
 
-    # Load session
-    state = get_session(req.sessionId)
-    if not state:
-        state = init_session(req.sessionId)
-
-    state["turns"] += 1
     incoming_text = req.message.text
+    incoming_lower = incoming_text.lower()  # lowercase once, reuse everywhere
 
-    # Scam detection trigger
-    if not state["scamDetected"]:
-        if any(k in incoming_text.lower() for k in ["blocked", "verify", "kyc", "upi", "pay", "link", "otp", "suspend", "suspended"]):
-            state["scamDetected"] = True
+    # Pure per-message work happens before the transaction
+    delta = extract_intel(incoming_text, incoming_lower)
+    scam_trigger_hit = bool(keyword_hits(TRIGGER_AC, SCAM_TRIGGERS, incoming_lower))
 
-    # Extract intel
-    delta = extract_intel(incoming_text)
+    # Everything that touches session state lives in this closure; it
+    # may be replayed if a concurrent turn commits first, so no side
+    # effects here — the callback is enqueued after the commit.
+    def apply_turn(state):
+        state["turns"] += 1
 
-    got_new_item = False
-    for k in state["intel"]:
-        existing = set(state["intel"][k])
-        new_items = set(delta[k])
-        if not new_items.issubset(existing):
-            got_new_item = True
-        state["intel"][k] = list(existing.union(new_items))
-
-    if got_new_item:
-        state["noNewIntelTurns"] = 0
-    else:
-        state["noNewIntelTurns"] += 1
-
-    # Reply
-    if state["scamDetected"]:
-        reply = generate_reply()
-    else:
-        reply = "Hello? Who is this? I missed a call from this number."
-
-    # Stop conditions
-    MAX_TURNS = 18
-    STALL_LIMIT = 4
-
-    has_critical_data = (
-        len(state["intel"]["upiIds"]) > 0
-        or len(state["intel"]["bankAccounts"]) > 0
-        or len(state["intel"]["phishingLinks"]) > 0
-        or len(state["intel"]["phoneNumbers"]) > 0
-    )
-
-    should_close = False
-    if state["turns"] >= MAX_TURNS:
-        should_close = True
-    elif has_critical_data and state["noNewIntelTurns"] >= STALL_LIMIT:
-        should_close = True
-
-    # Mandatory callback (send once)
-    if should_close and not state["callbackSent"]:
-        final_payload = {
-            "sessionId": req.sessionId,
-            "scamDetected": True,
-            "totalMessagesExchanged": state["turns"],
-            "extractedIntelligence": state["intel"],
-            "agentNotes": "Scammer used urgency and credential/payment redirection tactics."
-        }
-
-        background_tasks.add_task(send_guvi_callback, final_payload)
-        state["callbackSent"] = True
+        # Scam detection trigger
+        if scam_trigger_hit and not state["scamDetected"]:
+            state["scamDetected"] = True
 
-        # End chat message (fake failure)
-        reply = "Network Error. Connection Lost."
+        got_new_item = False
+        for k, new_items in delta.items():
+            if not new_items:
+                continue
+            existing = state["intel"][k]
+            if isinstance(existing, list):  # state that round-tripped through Redis JSON
+                existing = set(existing)
+                state["intel"][k] = existing
+            added = new_items - existing
+            if added:
+                got_new_item = True
+                existing |= added
+
+        if got_new_item:
+            state["noNewIntelTurns"] = 0
+        else:
+            state["noNewIntelTurns"] += 1
+
+        # Reply
+        if state["scamDetected"]:
+            reply = generate_reply()
+        else:
+            reply = "Hello? Who is this? I missed a call from this number."
+
+        # Stop conditions
+        MAX_TURNS = 18
+        STALL_LIMIT = 4
+
+        has_critical_data = any(state["intel"][k] for k in CRITICAL_KEYS)
+
+        should_close = False
+        if state["turns"] >= MAX_TURNS:
+            should_close = True
+        elif has_critical_data and state["noNewIntelTurns"] >= STALL_LIMIT:
+            should_close = True
+
+        # Mandatory callback (send once)
+        final_payload = None
+        if should_close and not state["callbackSent"]:
+            final_payload = {
+                "sessionId": req.sessionId,
+                "scamDetected": True,
+                "totalMessagesExchanged": state["turns"],
+                "extractedIntelligence": intel_as_lists(state["intel"]),
+                "agentNotes": "Scammer used urgency and credential/payment redirection tactics."
+            }
+            state["callbackSent"] = True
+
+            # End chat message (fake failure)
+            reply = "Network Error. Connection Lost."
+
+        return reply, final_payload
+
+    reply, final_payload = await update_session(req.sessionId, apply_turn)
+
+    if final_payload:
+        if CALLBACK_QUEUE is not None:
+            await CALLBACK_QUEUE.put(final_payload)
+        else:  # startup hook didn't run (e.g. bare test harness)
+            background_tasks.add_task(send_guvi_callback, final_payload)
 
-    save_session(req.sessionId, state)
     return {"status": "success", "reply": reply}
 
 @app.get("/health")